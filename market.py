@@ -1,13 +1,36 @@
+import asyncio
 import datetime
-import logging.config
+import logging
 from environs import Env
 from seller import download_stock
 
 import requests
 
-from seller import divide, price_conversion
-
-logger = logging.getLogger(__file__)
+from seller import (
+    OFFER_IDS_TTL,
+    TIMEOUT,
+    convert_prices,
+    convert_stocks,
+    create_session,
+    divide,
+    loads_json,
+    prepare_executor,
+    select_watches,
+    send_json,
+    ttl_cache,
+    upload_chunks,
+)
+
+logger = logging.getLogger(__name__)
+
+YM_BASE = "https://api.partner.market.yandex.ru/"
+YM_STOCKS_CHUNK = 2000
+YM_PRICES_CHUNK = 500
+# Маркет не документирует прием сжатых запросов, поэтому gzip выключен
+YM_GZIP_REQUESTS = False
+
+session = create_session()
+session.headers.update({"Accept": "application/json"})
 
 
 def get_product_list(page, campaign_id, access_token):
@@ -30,21 +53,15 @@ def get_product_list(page, campaign_id, access_token):
         *requests.exceptions.HTTPError:
     """
 
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    url = YM_BASE + f"campaigns/{campaign_id}/offer-mapping-entries"
+    response = session.get(url, headers=headers, params=payload, timeout=TIMEOUT)
     response.raise_for_status()
-    response_object = response.json()
+    response_object = loads_json(response.content)
     return response_object.get("result")
 
 
@@ -68,19 +85,10 @@ def update_stocks(stocks, campaign_id, access_token):
         *requests.exceptions.HTTPError:
     """
     
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    url = YM_BASE + f"campaigns/{campaign_id}/offers/stocks"
+    return send_json(session, "PUT", url, payload, headers, compress=YM_GZIP_REQUESTS)
 
 
 def update_price(prices, campaign_id, access_token):
@@ -103,21 +111,13 @@ def update_price(prices, campaign_id, access_token):
         *requests.exceptions.HTTPError:
     """
 
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = {"Authorization": f"Bearer {access_token}"}
     payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
-    response.raise_for_status()
-    response_object = response.json()
-    return response_object
+    url = YM_BASE + f"campaigns/{campaign_id}/offer-prices/updates"
+    return send_json(session, "POST", url, payload, headers, compress=YM_GZIP_REQUESTS)
 
 
+@ttl_cache(OFFER_IDS_TTL)
 def get_offer_ids(campaign_id, market_token):
     """Получить артикулы товаров Яндекс маркета
 
@@ -136,25 +136,59 @@ def get_offer_ids(campaign_id, market_token):
     """
 
     page = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        offer_ids.extend(
+            product.get("offer").get("shopSku")
+            for product in some_prod.get("offerMappingEntries")
+        )
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
     return offer_ids
 
 
+def iter_stocks(watch_remnants, offer_ids, warehouse_id):
+    """Функция по одному возвращает остатки часов к продаже.
+
+    Сначала возвращаются часы из таблицы остатков, затем с нулевым остатком
+    товары магазина, которых в таблице нет.
+
+    Args:
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
+        warehouse_id (str): Идентификатор логистики.
+
+    Yields:
+        (dict): Информация о продаваемых часах.
+
+    Example:
+        >>> print(next(iter_stocks(watch_remnants, offer_ids, warehouse_id)))
+        *{"sku": "68052", "warehouseId": "1", "items": [{"count": 100, ...}]}
+    """
+
+    date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    watches = select_watches(watch_remnants, offer_ids)
+    seen = set(watches["Код"])
+    counts = convert_stocks(watches["Количество"])
+    # Одинаковые остатки ссылаются на один и тот же неизменяемый список items
+    items = {
+        count: [{"count": count, "type": "FIT", "updatedAt": date}]
+        for count in {0, *counts}
+    }
+    for code, stock in zip(watches["Код"], counts):
+        yield {"sku": code, "warehouseId": warehouse_id, "items": items[stock]}
+    for offer_id in offer_ids - seen:
+        yield {"sku": offer_id, "warehouseId": warehouse_id, "items": items[0]}
+
+
 def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Функция создает список часов к продаже.
 
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
-        offer_ids (list): Список с идентификаторами товаров.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
         warehouse_id (str): Идентификатор логистики.
 
     Returns:
@@ -166,54 +200,15 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
         *"Список с информацией о продаваемых часах"
     """
     
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
-                {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
-                }
-            )
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
-        )
-    return stocks
+    return list(iter_stocks(watch_remnants, offer_ids, warehouse_id))
 
 
 def create_prices(watch_remnants, offer_ids):
     """Создает список с информацией о ценах.
     
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
-        offer_ids (list): Список с идентификаторами товаров.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
 
     Returns:
         (list): Список с с информацией о ценах.
@@ -223,30 +218,32 @@ def create_prices(watch_remnants, offer_ids):
         >>> print(prices)
         *"Список с с информацией о ценах"
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    watches = select_watches(watch_remnants, offer_ids)
+    values = convert_prices(watches["Цена"])
+    prices = [
+        {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": int(value),
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        for code, value in zip(watches["Код"].loc[values.index], values)
+    ]
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(watch_remnants, offer_ids, campaign_id, market_token):
     """Запрашивает цены на товары и обновляет их.
 
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
         campaign_id (str): Идентификатор комании.
         market_token (str): Токен авторизации.
 
@@ -254,18 +251,21 @@ async def upload_prices(watch_remnants, campaign_id, market_token):
         (list): Список цен.
     """
 
-    offer_ids = get_offer_ids(campaign_id, market_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await upload_chunks(
+        update_price, divide(prices, YM_PRICES_CHUNK), campaign_id, market_token
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants, offer_ids, campaign_id, market_token, warehouse_id
+):
     """Запрашивает список с товарами и обновляет их.
 
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
         campaign_id (str): Идентификатор комании.
         market_token (str): Токен авторизации.
         warehouse_id (str): Идентификатор логистики.
@@ -274,17 +274,40 @@ async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
         (list): Список товаров.
     """
 
-    offer_ids = get_offer_ids(campaign_id, market_token)
-    stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
+    chunks = divide(
+        iter_stocks(watch_remnants, offer_ids, warehouse_id), YM_STOCKS_CHUNK
+    )
+    uploaded = await upload_chunks(update_stocks, chunks, campaign_id, market_token)
+    stocks = [stock for chunk in uploaded for stock in chunk]
     not_empty = list(
         filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
     )
     return not_empty, stocks
 
 
-def main():
+async def run_campaign(watch_remnants, campaign_id, market_token, warehouse_id):
+    """Обновляет остатки и цены товаров одной кампании.
+
+    Args:
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        campaign_id (str): Идентификатор комании.
+        market_token (str): Токен авторизации.
+        warehouse_id (str): Идентификатор логистики.
+    """
+
+    loop = asyncio.get_running_loop()
+    offer_ids = set(
+        await loop.run_in_executor(
+            prepare_executor, get_offer_ids, campaign_id, market_token
+        )
+    )
+    await upload_stocks(
+        watch_remnants, offer_ids, campaign_id, market_token, warehouse_id
+    )
+    await upload_prices(watch_remnants, offer_ids, campaign_id, market_token)
+
+
+async def amain():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
     campaign_fbs_id = env.str("FBS_ID")
@@ -293,25 +316,25 @@ def main():
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
     watch_remnants = download_stock()
-    try:
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
-    except requests.exceptions.ReadTimeout:
-        print("Превышено время ожидания...")
-    except requests.exceptions.ConnectionError as error:
-        print(error, "Ошибка соединения")
-    except Exception as error:
-        print(error, "ERROR_2")
-
+    campaigns = [
+        (campaign_fbs_id, warehouse_fbs_id),
+        (campaign_dbs_id, warehouse_dbs_id),
+    ]
+    # Ошибка одной кампании не должна прерывать обновление другой
+    results = await asyncio.gather(
+        *(
+            run_campaign(watch_remnants, campaign_id, market_token, warehouse_id)
+            for campaign_id, warehouse_id in campaigns
+        ),
+        return_exceptions=True,
+    )
+    for (campaign_id, _), error in zip(campaigns, results):
+        if isinstance(error, requests.exceptions.ReadTimeout):
+            print(campaign_id, "Превышено время ожидания...")
+        elif isinstance(error, requests.exceptions.ConnectionError):
+            print(campaign_id, error, "Ошибка соединения")
+        elif isinstance(error, Exception):
+            print(campaign_id, error, "ERROR_2")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(amain())
@@ -1,14 +1,188 @@
+import asyncio
+import functools
+import gzip
+import hashlib
 import io
-import logging.config
-import os
+import itertools
+import json
+import logging
+import math
+import numbers
 import re
+import threading
+import time
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from environs import Env
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-logger = logging.getLogger(__file__)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+TIMEOUT = (5, 30)
+UPLOAD_CONCURRENCY = 8
+OZON_STOCKS_CHUNK = 100
+OZON_PRICES_CHUNK = 1000
+OFFER_IDS_TTL = 300
+# Ozon не документирует прием сжатых запросов, поэтому gzip выключен
+OZON_GZIP_REQUESTS = False
+
+_PRICE_RE = re.compile(r"[^0-9]")
+
+
+def create_session():
+    """Создать сессию с пулом соединений и повтором неудачных запросов
+
+    Returns:
+        (requests.Session): Сессия для запросов к API.
+
+    Example:
+        >>> session = create_session()
+        >>> response = session.get(url, timeout=TIMEOUT)
+    """
+
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET", "POST", "PUT"]),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=retries)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    return session
+
+
+session = create_session()
+# Отдельные пулы потоков: отправка частей не занимает потоки подготовки данных
+upload_executor = ThreadPoolExecutor(
+    max_workers=UPLOAD_CONCURRENCY * 2, thread_name_prefix="upload"
+)
+prepare_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prepare")
+
+
+def dumps_json(payload):
+    """Сериализовать тело запроса в JSON
+
+    Используется orjson, если он установлен, иначе стандартный json.
+
+    Args:
+        payload (dict): Тело запроса.
+
+    Returns:
+        (bytes): JSON в кодировке UTF-8.
+
+    Example:
+        >>> dumps_json({"stocks": []})
+        *b'{"stocks":[]}'
+    """
+
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def loads_json(content):
+    """Разобрать JSON из ответа API
+
+    Args:
+        content (bytes): Тело ответа.
+
+    Returns:
+        (dict): Разобранный ответ.
+
+    Example:
+        >>> loads_json(response.content)
+        *{"Массив с ответом"}
+    """
+
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def send_json(session, method, url, payload, headers, compress=False):
+    """Отправить JSON в API и вернуть разобранный ответ
+
+    Args:
+        session (requests.Session): Сессия для запросов к API.
+        method (str): HTTP метод.
+        url (str): Адрес запроса.
+        payload (dict): Тело запроса.
+        headers (dict): Заголовки запроса.
+        compress (bool): Сжать тело запроса gzip.
+
+    Returns:
+        (dict): Разобранный ответ.
+
+    Example:
+        >>> send_json(session, "POST", url, {"stocks": stocks}, headers)
+        *{"Массив с ответом"}
+
+    Example:
+        >>> send_json(session, "POST", url, {"stocks": stocks}, headers)
+        *requests.exceptions.HTTPError:
+    """
+
+    body = dumps_json(payload)
+    headers = {**headers, "Content-Type": "application/json"}
+    if compress:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    response = session.request(method, url, data=body, headers=headers, timeout=TIMEOUT)
+    response.raise_for_status()
+    return loads_json(response.content)
+
+
+def ttl_cache(ttl):
+    """Кешировать результат функции на ttl секунд
+
+    Ключом служит хеш аргументов, поэтому токены в кеше не хранятся.
+    Закешированный результат возвращается как есть, его нельзя изменять.
+
+    Args:
+        ttl (int): Время жизни записи в секундах.
+
+    Returns:
+        (function): Декоратор.
+
+    Example:
+        >>> @ttl_cache(OFFER_IDS_TTL)
+        >>> def get_offer_ids(client_id, seller_token): ...
+    """
+
+    def decorator(function):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            key = hashlib.blake2b(repr(args).encode(), digest_size=8).hexdigest()
+            with lock:
+                now = time.monotonic()
+                if key in cache and now - cache[key][0] < ttl:
+                    return cache[key][1]
+            result = function(*args)
+            with lock:
+                now = time.monotonic()
+                expired = [k for k, (added, _) in cache.items() if now - added >= ttl]
+                for k in expired:
+                    del cache[k]
+                cache[key] = (now, result)
+            return result
+
+        return wrapper
+
+    return decorator
 
 
 def get_product_list(last_id, client_id, seller_token):
@@ -43,12 +217,11 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    response_object = response.json()
+    response_object = send_json(session, "POST", url, payload, headers)
     return response_object.get("result")
 
 
+@ttl_cache(OFFER_IDS_TTL)
 def get_offer_ids(client_id, seller_token):
     """Получить артикулы товаров магазина озон
 
@@ -66,17 +239,15 @@ def get_offer_ids(client_id, seller_token):
     """
 
     last_id = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+        items = some_prod.get("items")
+        offer_ids.extend(product.get("offer_id") for product in items)
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if total == len(offer_ids) or not items:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
     return offer_ids
 
 
@@ -106,9 +277,9 @@ def update_price(prices: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return send_json(
+        session, "POST", url, payload, headers, compress=OZON_GZIP_REQUESTS
+    )
 
 
 def update_stocks(stocks: list, client_id, seller_token):
@@ -137,46 +308,136 @@ def update_stocks(stocks: list, client_id, seller_token):
         "Api-Key": seller_token,
     }
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return send_json(
+        session, "POST", url, payload, headers, compress=OZON_GZIP_REQUESTS
+    )
 
 
 def download_stock():
-    """Функция скачивает файл с остатками часов и преобразует его в словарь.
+    """Функция скачивает файл с остатками часов и преобразует его в таблицу.
 
     Returns:
-        (dict): Словарь с информацией об оставшихся часах.
+        (pandas.DataFrame): Таблица с информацией об оставшихся часах.
 
     Example: 
         >>> watch_remnants = download_stock()
-        >>> print(watch_remnants)
-        *{"Массив с ответом"}
+        >>> print(watch_remnants[["Код", "Количество", "Цена"]])
+        *     Код Количество           Цена
+        *0  68052        >10  5'990.00 руб.
+        *1  76031          1  4'290.00 руб.
     """
     
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
-    response.raise_for_status()
-    with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")  
+    archive_file = io.BytesIO()
+    with session.get(casio_url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            archive_file.write(chunk)
+    read_options = {"na_values": None, "keep_default_na": False, "header": 17}
+    with zipfile.ZipFile(archive_file) as archive:
+        with archive.open("ostatki.xls") as excel_file:
+            try:
+                watch_remnants = pd.read_excel(
+                    io=excel_file, engine="calamine", **read_options
+                )
+            except (ImportError, ValueError):
+                # Нет python-calamine или pandas < 2.2: формат определит pandas
+                excel_file.seek(0)
+                watch_remnants = pd.read_excel(io=excel_file, **read_options)
     return watch_remnants
 
 
+def select_watches(watch_remnants, offer_ids):
+    """Отобрать часы, выставленные в магазине.
+
+    Args:
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
+
+    Returns:
+        (pandas.DataFrame): Строки таблицы без повторов, "Код" приведен к строке.
+
+    Example:
+        >>> watches = select_watches(watch_remnants, {"68052", "76031"})
+        >>> print(watches["Код"].tolist())
+        *["68052", "76031"]
+    """
+    codes = watch_remnants["Код"].astype(str)
+    watches = watch_remnants[codes.isin(offer_ids)].assign(Код=codes)
+    return watches.drop_duplicates("Код")
+
+
+def convert_stocks(counts):
+    """Преобразование количества часов в остатки.
+
+    Args:
+        counts (pandas.Series): Столбец "Количество".
+
+    Returns:
+        (pandas.Series): Остатки часов.
+
+    Example:
+        ">10" -> 100, "1" -> 0, "5" -> 5
+    """
+    counts = counts.astype(str)
+    stocks = pd.to_numeric(counts, errors="coerce").fillna(0).astype(int)
+    return stocks.mask(counts == ">10", 100).mask(counts == "1", 0)
+
+
+def convert_prices(prices):
+    """Преобразование столбца цен.
+
+    Пустые цены, NaN и строки без цифр отбрасываются.
+
+    Args:
+        prices (pandas.Series): Столбец "Цена".
+
+    Returns:
+        (pandas.Series): Преобразованные цены с индексами исходных строк.
+
+    Example:
+        5'990.00 руб. -> 5990
+    """
+    digits = prices.map(price_conversion)
+    digits = digits[digits != ""]
+    skipped = len(prices) - len(digits)
+    if skipped:
+        logger.warning("Пропущено строк с пустой или нечитаемой ценой: %d", skipped)
+    return digits
+
+
+def iter_stocks(watch_remnants, offer_ids):
+    """Функция по одному возвращает остатки часов к продаже.
+
+    Сначала возвращаются часы из таблицы остатков, затем с нулевым остатком
+    товары магазина, которых в таблице нет.
+
+    Args:
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
+
+    Yields:
+        (dict): Информация о продаваемых часах.
+
+    Example:
+        >>> print(next(iter_stocks(watch_remnants, offer_ids)))
+        *{"offer_id": "68052", "stock": 100}
+    """
+
+    watches = select_watches(watch_remnants, offer_ids)
+    seen = set(watches["Код"])
+    for code, stock in zip(watches["Код"], convert_stocks(watches["Количество"])):
+        yield {"offer_id": code, "stock": stock}
+    for offer_id in offer_ids - seen:
+        yield {"offer_id": offer_id, "stock": 0}
+
+
 def create_stocks(watch_remnants, offer_ids):
     """Функция создает список часов к продаже.
 
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
-        offer_ids (list): Список с идентификаторами товаров.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
 
     Returns:
         (list): Список с информацией о продаваемых часах.
@@ -187,29 +448,15 @@ def create_stocks(watch_remnants, offer_ids):
         *"Список с информацией о продаваемых часах"
     """
     
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
-    return stocks
+    return list(iter_stocks(watch_remnants, offer_ids))
 
 
 def create_prices(watch_remnants, offer_ids):
     """Создает список с информацией о ценах.
     
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
-        offer_ids (list): Список с идентификаторами товаров.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
 
     Returns:
         (list): Список с с информацией о ценах.
@@ -219,61 +466,122 @@ def create_prices(watch_remnants, offer_ids):
         >>> print(prices)
         *"Список с с информацией о ценах"
     """
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    watches = select_watches(watch_remnants, offer_ids)
+    values = convert_prices(watches["Цена"])
+    prices = [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": value,
+        }
+        for code, value in zip(watches["Код"].loc[values.index], values)
+    ]
     return prices
 
 
-def price_conversion(price: str) -> str:
+def price_conversion(price) -> str:
     """Преобразование цены.
     
     Args:
-        price (str): цена.
+        price (str | int | float): цена.
     
     Returns:
-        (str): Преобразованная цена.
+        (str): Преобразованная цена, пустая строка для пустой цены.
     
     Example: 
         5'990.00 руб. -> 5990
+        5990.0 -> 5990
+        None -> ""
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    if isinstance(price, str):
+        return _PRICE_RE.sub("", price.split(".", 1)[0])
+    if isinstance(price, numbers.Real) and not isinstance(price, bool):
+        if math.isfinite(price):
+            return str(int(price))
+    return ""
 
 
-def divide(lst: list, n: int):
-    """Разделить список lst на части по n элементов
+def divide(items, n: int):
+    """Разделить последовательность items на части по n элементов
 
     Args:
-        lst (list): Разделяемый список.
-        n (int): Количество элементов в срезе списка.
+        items (iterable): Разделяемая последовательность, в том числе генератор.
+        n (int): Количество элементов в части.
 
     Returns:
-        (list): Срез списка.
+        (list): Часть последовательности.
 
     Example: 
-        >>> for some_stock in list(divide(stocks, 3)):
+        >>> for some_stock in divide(stocks, 3):
         >>>     print(some_stock)
         *[4990, 4990, 4290]
         *[43990, 2990, 4290]
     """
 
-    for i in range(0, len(lst), n):
-        yield lst[i : i + n]
+    iterator = iter(items)
+    while chunk := list(itertools.islice(iterator, n)):
+        yield chunk
+
+
+async def upload_chunks(update, chunks, *args):
+    """Отправить части списка конвейером
 
+    Следующая часть готовится в потоке prepare_executor, пока предыдущие
+    отправляются. Каждая часть отправляется функцией update в потоке
+    upload_executor, одновременно выполняется не больше UPLOAD_CONCURRENCY
+    запросов.
+
+    Args:
+        update (function): Функция отправки одной части.
+        chunks (iterable): Части списка для отправки.
+        *args: Дополнительные аргументы для update.
+
+    Returns:
+        (list): Отправленные части.
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+    Example:
+        >>> chunks = divide(iter_stocks(watch_remnants, offer_ids), 100)
+        >>> await upload_chunks(update_stocks, chunks, client_id, seller_token)
+        *[[{"offer_id": "68052", "stock": 100}, ...], ...]
+    """
+
+    loop = asyncio.get_running_loop()
+    chunks = iter(chunks)
+    queue = asyncio.Queue(maxsize=2)
+    uploaded = []
+
+    async def produce():
+        while True:
+            chunk = await loop.run_in_executor(prepare_executor, next, chunks, None)
+            if chunk is None:
+                break
+            uploaded.append(chunk)
+            await queue.put(chunk)
+        for _ in range(UPLOAD_CONCURRENCY):
+            await queue.put(None)
+
+    async def consume():
+        while (chunk := await queue.get()) is not None:
+            await loop.run_in_executor(upload_executor, update, chunk, *args)
+
+    tasks = [asyncio.create_task(produce())]
+    tasks.extend(asyncio.create_task(consume()) for _ in range(UPLOAD_CONCURRENCY))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return uploaded
+
+
+async def upload_prices(watch_remnants, offer_ids, client_id, seller_token):
     """Запрашивает цены на товары и обновляет их.
 
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
         client_id (str): ID клиента.
         seller_token (str): API токен продавца.
 
@@ -281,18 +589,19 @@ async def upload_prices(watch_remnants, client_id, seller_token):
         (list): Список цен.
     """
 
-    offer_ids = get_offer_ids(client_id, seller_token)
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await upload_chunks(
+        update_price, divide(prices, OZON_PRICES_CHUNK), client_id, seller_token
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(watch_remnants, offer_ids, client_id, seller_token):
     """Запрашивает список с товарами и обновляет их.
 
     Args:
-        watch_remnants (dict): Словарь с информацией об оставшихся часах.
+        watch_remnants (pandas.DataFrame): Таблица с информацией об оставшихся часах.
+        offer_ids (set): Множество идентификаторов товаров.
         client_id (str): ID клиента.
         seller_token (str): API токен продавца.
 
@@ -300,29 +609,24 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
         (list): Список товаров.
     """
 
-    offer_ids = get_offer_ids(client_id, seller_token)
-    stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
+    chunks = divide(iter_stocks(watch_remnants, offer_ids), OZON_STOCKS_CHUNK)
+    uploaded = await upload_chunks(update_stocks, chunks, client_id, seller_token)
+    stocks = [stock for chunk in uploaded for stock in chunk]
     not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
     return not_empty, stocks
 
 
-def main():
+async def amain():
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
+        offer_ids = set(get_offer_ids(client_id, seller_token))
         watch_remnants = download_stock()
         # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
+        await upload_stocks(watch_remnants, offer_ids, client_id, seller_token)
         # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        await upload_prices(watch_remnants, offer_ids, client_id, seller_token)
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
@@ -332,4 +636,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(amain())